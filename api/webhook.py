@@ -1,17 +1,25 @@
 # api/webhook.py
 import os
 import asyncio
-import json
 import time
 import logging
 import re
 import ssl
+import sys
+import base64
 import hashlib
+import secrets
+import orjson
+from functools import partial
+from random import uniform
 from dataclasses import dataclass
-from typing import Optional, List, Tuple, Dict
-from urllib.parse import urlparse
+from typing import Optional, List, Tuple, Dict, NamedTuple
+from urllib.parse import quote
+
+import aiohttp
 
 from fastapi import FastAPI, Request, HTTPException
+from fastapi.responses import ORJSONResponse
 from aiogram import Bot, Dispatcher, types
 from aiogram.types import (
     ReplyKeyboardMarkup, KeyboardButton,
@@ -19,11 +27,14 @@ from aiogram.types import (
     InputMediaPhoto, InputMediaVideo
 )
 from aiogram.filters import Command
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.exceptions import TelegramRetryAfter
+from aiolimiter import AsyncLimiter
 from google.oauth2.service_account import Credentials
-from googleapiclient.discovery import build
-from googleapiclient.errors import HttpError
+from google.auth.transport.requests import Request as GoogleAuthRequest
 from cachetools import TTLCache
-from collections import OrderedDict
+from redis import asyncio as aioredis
+from redis.exceptions import RedisError
 from dotenv import load_dotenv
 
 # ---------------------- ENV & LOGGING ----------------------
@@ -32,8 +43,6 @@ logging.basicConfig(
     level=os.getenv("LOG_LEVEL", "INFO"),
     format="%(asctime)s - %(levelname)s - %(message)s"
 )
-logging.getLogger("googleapiclient.discovery").setLevel(logging.WARNING)
-logging.getLogger("googleapiclient.discovery_cache").setLevel(logging.ERROR)
 logging.getLogger("aiogram.client.session").setLevel(logging.WARNING)
 
 def _mask(s: Optional[str], keep_tail: int = 6) -> str:
@@ -56,293 +65,614 @@ class Config:
     GOOGLE_SERVICE_ACCOUNT_KEY: str
     SHEET_ID: str
     RANGE_NAME: str = "Guides!A:C"   # А, B, C: Parent | Button | Text
+    REDIS_URL: str = ""              # общий стор сессий/гайдов для всех инстансов Vercel
+    TG_CONNECTION_LIMIT: int = 100   # размер пула keep-alive соединений к Bot API
 
 _raw_token = os.getenv("BOT_TOKEN") or os.getenv("TELEGRAM_BOT_TOKEN")
 config = Config(
     BOT_TOKEN=clean_token(_raw_token) or "",
     GOOGLE_SERVICE_ACCOUNT_KEY=os.getenv("GOOGLE_SERVICE_ACCOUNT_KEY") or "",
-    SHEET_ID=(os.getenv("GOOGLE_SHEET_ID") or os.getenv("SHEET_ID") or "")
+    SHEET_ID=(os.getenv("GOOGLE_SHEET_ID") or os.getenv("SHEET_ID") or ""),
+    REDIS_URL=os.getenv("REDIS_URL") or "",
+    TG_CONNECTION_LIMIT=int(os.getenv("TG_CONNECTION_LIMIT", "100")),
 )
 if not config.BOT_TOKEN or not config.GOOGLE_SERVICE_ACCOUNT_KEY or not config.SHEET_ID:
     raise RuntimeError("Missing envs: BOT_TOKEN, GOOGLE_SERVICE_ACCOUNT_KEY, GOOGLE_SHEET_ID/SHEET_ID")
 
 # ---------------------- GLOBALS ----------------------
-bot = Bot(token=config.BOT_TOKEN)
+async def tg_rate_limit(make_request, bot: Bot, method):
+    """Request-middleware сессии: все вызовы Bot API идут через общий лимитер, на флуд-контроль ждём retry_after."""
+    for attempt in range(1, TG_MAX_RETRIES + 1):
+        async with tg_send_limit:
+            try:
+                return await make_request(bot, method)
+            except TelegramRetryAfter as e:
+                if attempt == TG_MAX_RETRIES:
+                    raise
+                wait = e.retry_after
+                logging.warning(f"Telegram flood control on {type(method).__name__}, retry in {wait}s")
+        await asyncio.sleep(wait)
+
+# явная сессия: пул с keep-alive и DNS-кэшем переживает тёплые вызовы функции;
+# лимитер в middleware покрывает и ответы хендлеров (message.answer, callback.answer)
+tg_session = AiohttpSession(limit=config.TG_CONNECTION_LIMIT)
+tg_session.middleware(tg_rate_limit)
+bot = Bot(token=config.BOT_TOKEN, session=tg_session)
 dp = Dispatcher()
-app = FastAPI()
+# ответы (в т.ч. ACK вебхука) сериализуются orjson, без стандартного json-энкодера
+app = FastAPI(default_response_class=ORJSONResponse)
 
 SCOPES = [
     "https://www.googleapis.com/auth/spreadsheets",
     "https://www.googleapis.com/auth/drive.metadata.readonly",
 ]
+# ключ сервис-аккаунта разбираем один раз на импорте — не на первом запросе;
+# битый ключ не должен ронять импорт: /start и ping без Google продолжают работать
+try:
+    CREDS_INFO: Optional[dict] = orjson.loads(config.GOOGLE_SERVICE_ACCOUNT_KEY)
+except orjson.JSONDecodeError as e:
+    logging.error(f"GOOGLE_SERVICE_ACCOUNT_KEY is not valid JSON: {e}")
+    CREDS_INFO = None
 CREDS: Optional[Credentials] = None
-SHEETS_SERVICE = None
-DRIVE_SERVICE = None
+# REST напрямую через aiohttp: без discovery-документа и синхронного httplib2
+SHEETS_VALUES_URL = "https://sheets.googleapis.com/v4/spreadsheets/{sheet_id}/values/{range}"
+DRIVE_FILE_URL = "https://www.googleapis.com/drive/v3/files/{file_id}"
+GOOGLE_TIMEOUT = aiohttp.ClientTimeout(total=15)
+_http: Optional[aiohttp.ClientSession] = None
 
 main_buttons: List[str] = []
+main_buttons_set: frozenset = frozenset()     # для O(1) проверки `txt in ...`, порядок — в main_buttons
 submenus: Dict[str, List[str]] = {}
 texts: Dict[str, str] = {}
-main_menu: Optional[ReplyKeyboardMarkup] = None
 
-guides_cache = TTLCache(maxsize=1, ttl=300)   # 5 минут
-sessions: Dict[int, float] = {}               # in-memory TTL 30 минут
+class Guide(NamedTuple):
+    """Гайд, разобранный один раз при загрузке: отправка только распаковывает поля."""
+    clean_text: str                      # текст без ссылок
+    media_list: List[types.InputMedia]   # альбом фото/видео (до 10)
+    anims: List[str]
+    docs: List[str]
+
+parsed_guides: Dict[str, Guide] = {}
+cb_index: Dict[str, str] = {}                 # cb_hash -> кнопка, для callback_data "sub#..."
+main_menu: Optional[ReplyKeyboardMarkup] = None
+submenu_markups: Dict[str, InlineKeyboardMarkup] = {}
+last_modified_time: Optional[str] = None      # modifiedTime таблицы из Drive на момент загрузки
+
+GUIDES_CACHE_TTL = 300                        # 5 минут
+guides_fresh_until = 0.0                      # time.monotonic(), до которого гайды считаются свежими
+guides_checked_at = 0.0                       # time.time() последней сверки с Sheets (любым инстансом)
+tg_send_limit = AsyncLimiter(25, 1.0)         # Bot API ~30 msg/sec на бота
+TG_MAX_RETRIES = 3
+SESSION_TTL = 1800                            # 30 минут
+sessions = TTLCache(maxsize=100_000, ttl=SESSION_TTL)  # фолбэк, если нет REDIS_URL
+SESSION_CACHE_TTL = 60                        # локальная копия подтверждённых сессий поверх Redis
+session_cache = TTLCache(maxsize=100_000, ttl=SESSION_CACHE_TTL)
+
+GUIDES_KEY = "guides:v1"
+GUIDES_TTL = 300
+GUIDES_LEASE_KEY = "guides:lease"
+GUIDES_LEASE_TTL = 10
+GUIDES_LEASE_WAIT = 1.5                       # сколько ждём чужое обновление, прежде чем идти в Sheets самим
+_guides_lock = asyncio.Lock()
+_redis: Optional[aioredis.Redis] = None
 
 # ---------------------- UTILS ----------------------
-URL_RE = re.compile(r'https?://(?:[a-zA-Z0-9]|[$-_@.&+]|[!*\(\),]|(?:%[0-9a-fA-F][0-9a-fA-F]))+')
-PHOTO_EXTS = {".jpg", ".jpeg", ".png", ".webp"}
-VIDEO_EXTS = {".mp4"}
-ANIM_EXTS  = {".gif"}
-DOC_EXTS   = {".pdf", ".svg"}
-
-def extract_urls_ordered(text: str) -> List[str]:
-    urls = URL_RE.findall(text or "")
-    seen = OrderedDict()
-    for u in urls:
-        seen.setdefault(u, True)
-    return list(seen.keys())
-
-def ext_of(url: str) -> str:
-    path = urlparse(url).path
-    return os.path.splitext(path)[1].lower()
+# одна символьная группа вместо альтернации — без лишнего бэктрекинга на длинных текстах;
+# потолок длины (лимит URL у Telegram ~2 КБ) ограничивает работу на одном совпадении
+URL_RE = re.compile(r'https?://[^\s<>"\'\])}]{1,2048}')
+SANITIZE_RE = re.compile(r"[^\w\s-]")
+PHOTO_EXTS = (".jpg", ".jpeg", ".png", ".webp")
+VIDEO_EXTS = (".mp4",)
+ANIM_EXTS  = (".gif",)
+DOC_EXTS   = (".pdf", ".svg")
+# расширение -> тип вложения: один поиск в словаре вместо цепочки endswith; неизвестное — документ
+MEDIA_KIND: Dict[str, str] = {
+    **dict.fromkeys(PHOTO_EXTS, "photo"),
+    **dict.fromkeys(VIDEO_EXTS, "video"),
+    **dict.fromkeys(ANIM_EXTS, "anim"),
+    **dict.fromkeys(DOC_EXTS, "doc"),
+}
+
+def split_urls(text: str) -> Tuple[List[str], str]:
+    """
+    Делит текст гайда за один проход URL_RE: ссылки (без дублей, в порядке появления)
+    и текст с вырезанными ссылками.
+    """
+    urls: List[str] = []
+
+    def _cap(m: re.Match) -> str:
+        urls.append(m.group(0))
+        return ""
+
+    text_without_urls = URL_RE.sub(_cap, text or "")
+    return list(dict.fromkeys(urls)), text_without_urls
 
 def split_media(urls: List[str]) -> Tuple[List[types.InputMedia], List[str], List[str]]:
     media_items: List[types.InputMedia] = []
     anims: List[str] = []
     docs: List[str] = []
     for url in urls:
-        e = ext_of(url)
-        if e in PHOTO_EXTS:
+        path = url.lower().split("?", 1)[0].split("#", 1)[0]
+        kind = MEDIA_KIND.get("." + path.rpartition(".")[2])
+        if kind == "photo":
             media_items.append(InputMediaPhoto(media=url))
-        elif e in VIDEO_EXTS:
+        elif kind == "video":
             media_items.append(InputMediaVideo(media=url))
-        elif e in ANIM_EXTS:
+        elif kind == "anim":
             anims.append(url)
-        elif e in DOC_EXTS:
-            docs.append(url)
         else:
             docs.append(url)
     return media_items[:10], anims, docs
 
-def has_access(user_id: int) -> bool:
-    now = time.time()
-    for u, t in list(sessions.items()):
-        if t < now:
-            sessions.pop(u, None)
-    return sessions.get(user_id, 0) > now
+def parse_guide(text: str) -> Guide:
+    text = text.strip()
+    urls, text_without_urls = split_urls(text)
+    media, anims, docs = split_media(urls)
+    return Guide(text_without_urls.strip(), media, anims, docs)
+
+NOT_FOUND_TEXT = "Текст не найден в Google Sheets."
+NOT_FOUND_GUIDE = parse_guide(NOT_FOUND_TEXT)
+
+def get_parsed_guide(btn: str) -> Guide:
+    return parsed_guides.get(btn) or NOT_FOUND_GUIDE
+
+def get_redis() -> Optional[aioredis.Redis]:
+    # ленивая инициализация: клиент создаётся в первом обработчике, а не на импорте
+    global _redis
+    if _redis is None and config.REDIS_URL:
+        _redis = aioredis.Redis.from_url(config.REDIS_URL)
+    return _redis
+
+async def has_access(user_id: int) -> bool:
+    if user_id in session_cache:
+        return True
+    r = get_redis()
+    if r is not None:
+        try:
+            # короткий TTL копии ограничивает рассинхрон с другими инстансами после сброса
+            ok = bool(await r.exists(f"sess:{user_id}"))
+            if ok:
+                session_cache[user_id] = True
+                return True
+        except (RedisError, OSError) as e:
+            logging.warning(f"Redis exists sess:{user_id} failed, using local sessions: {e}")
+    # TTLCache сам вычищает протухшие сессии — без полного прохода по словарю
+    return user_id in sessions
 
 async def grant_access(user_id: int):
-    sessions[user_id] = time.time() + 1800  # 30 минут
+    r = get_redis()
+    if r is not None:
+        try:
+            await r.setex(f"sess:{user_id}", SESSION_TTL, b"1")
+            session_cache[user_id] = True
+            return
+        except (RedisError, OSError) as e:
+            logging.warning(f"Redis setex sess:{user_id} failed, keeping session locally: {e}")
+    sessions[user_id] = True
 
-def reset_all_sessions():
+async def reset_all_sessions():
+    session_cache.clear()
     sessions.clear()
+    r = get_redis()
+    if r is None:
+        return
+    try:
+        keys = [k async for k in r.scan_iter(match="sess:*", count=500)]
+        if keys:
+            await r.delete(*keys)
+    except (RedisError, OSError) as e:
+        logging.warning(f"Redis session reset failed: {e}")
 
 def sanitize_text(text: str, sanitize=True) -> str:
     if sanitize:
-        return re.sub(r"[^\w\s-]", "", text.strip())[:100]
+        return SANITIZE_RE.sub("", text.strip())[:100]
     return text.strip()[:100]
 
+def cb_hash(btn: str) -> str:
+    # BLAKE2s сразу с 10-байтным дайджестом (без обрезки SHA1) в base64url — 14 символов в callback_data
+    digest = hashlib.blake2s(btn.encode("utf-8"), digest_size=10).digest()
+    return base64.urlsafe_b64encode(digest).decode("ascii").rstrip("=")
+
 def make_cb_data(btn: str) -> str:
     direct = f"sub|{btn}"
     if len(direct.encode("utf-8")) <= 64:
         return direct
-    return f"sub#{hashlib.sha1(btn.encode('utf-8')).hexdigest()[:32]}"
+    return f"sub#{cb_hash(btn)}"
 
 def resolve_btn_from_cb(data: str) -> Optional[str]:
     if data.startswith("sub|"):
         return data.split("|", 1)[1]
     if data.startswith("sub#"):
-        h = data[4:]
-        for k in texts.keys():
-            if hashlib.sha1(k.encode("utf-8")).hexdigest().startswith(h):
-                return k
+        return cb_index.get(data[4:])
     return None
 
 # ---------------------- GOOGLE CLIENTS ----------------------
+class GoogleApiError(Exception):
+    def __init__(self, status: int, body: str, retry_after: float = 0.0):
+        super().__init__(f"{status}: {body[:200]}")
+        self.status = status
+        self.retry_after = retry_after
+
 def ensure_google():
-    global CREDS, SHEETS_SERVICE, DRIVE_SERVICE
-    if SHEETS_SERVICE and DRIVE_SERVICE:
+    global CREDS
+    if CREDS is None:
+        if CREDS_INFO is None:
+            raise RuntimeError("GOOGLE_SERVICE_ACCOUNT_KEY is missing or malformed")
+        CREDS = Credentials.from_service_account_info(CREDS_INFO, scopes=SCOPES)
+
+def get_http() -> aiohttp.ClientSession:
+    global _http
+    if _http is None or _http.closed:
+        _http = aiohttp.ClientSession(timeout=GOOGLE_TIMEOUT)
+    return _http
+
+async def google_token() -> str:
+    ensure_google()
+    # valid учитывает запас до истечения; сам refresh синхронный — в поток
+    if not CREDS.valid:
+        await asyncio.to_thread(CREDS.refresh, GoogleAuthRequest())
+    return CREDS.token
+
+def parse_retry_after(value: Optional[str]) -> float:
+    try:
+        return float(value or 0)
+    except ValueError:
+        return 0.0
+
+async def google_get(url: str, **params) -> dict:
+    headers = {"Authorization": f"Bearer {await google_token()}"}
+    async with get_http().get(url, params=params, headers=headers) as resp:
+        body = await resp.read()
+        if resp.status >= 400:
+            raise GoogleApiError(
+                resp.status, body.decode("utf-8", "replace"), parse_retry_after(resp.headers.get("Retry-After"))
+            )
+        return orjson.loads(body)
+
+def guides_fresh() -> bool:
+    return time.monotonic() < guides_fresh_until
+
+def mark_guides_fresh(checked_at: Optional[float] = None):
+    # окно свежести считается от момента сверки с Sheets, а не от прихода копии из Redis
+    global guides_fresh_until, guides_checked_at
+    guides_checked_at = checked_at or time.time()
+    left = GUIDES_CACHE_TTL - (time.time() - guides_checked_at)
+    guides_fresh_until = time.monotonic() + max(0.0, left)
+
+def invalidate_guides():
+    global guides_fresh_until
+    guides_fresh_until = 0.0
+
+def apply_guides(
+    new_buttons: List[str], new_submenus: Dict[str, List[str]], new_texts: Dict[str, str],
+    modified_time: Optional[str] = None, checked_at: Optional[float] = None,
+):
+    global main_buttons, main_buttons_set, submenus, texts, parsed_guides, cb_index, main_menu, submenu_markups
+    global last_modified_time
+    last_modified_time = modified_time
+    main_buttons = [sys.intern(btn) for btn in new_buttons]
+    main_buttons_set = frozenset(main_buttons)
+    submenus, texts = new_submenus, new_texts
+    parsed_guides = {btn: parse_guide(text) for btn, text in new_texts.items()}
+    # callback_data считаем один раз на кнопку подменю; в индекс попадают только хэшированные
+    cb_data = {b: make_cb_data(b) for subs in new_submenus.values() for b in subs}
+    cb_index = {data[4:]: b for b, data in cb_data.items() if data.startswith("sub#")}
+    buttons = [[KeyboardButton(text=btn)] for btn in main_buttons]
+    # is_persistent — меню всегда доступно
+    main_menu = ReplyKeyboardMarkup(keyboard=buttons, resize_keyboard=True, is_persistent=True)
+    submenu_markups = {
+        parent: InlineKeyboardMarkup(inline_keyboard=[
+            [InlineKeyboardButton(text=b, callback_data=cb_data[b])] for b in subs
+        ])
+        for parent, subs in new_submenus.items()
+    }
+    mark_guides_fresh(checked_at)
+
+async def load_shared_guides() -> bool:
+    """
+    Берёт уже распарсенные гайды из Redis, если другой инстанс недавно сходил в Sheets.
+    """
+    r = get_redis()
+    if r is None:
+        return False
+    try:
+        raw = await r.get(GUIDES_KEY)
+    except Exception as e:
+        logging.warning(f"Redis get {GUIDES_KEY} failed: {e}")
+        return False
+    if not raw:
+        return False
+    payload = orjson.loads(raw)
+    apply_guides(
+        payload["main_buttons"], payload["submenus"], payload["texts"],
+        payload.get("modified_time"), payload.get("checked_at"),
+    )
+    return True
+
+async def store_shared_guides():
+    r = get_redis()
+    if r is None:
         return
-    creds_info = json.loads(config.GOOGLE_SERVICE_ACCOUNT_KEY)
-    CREDS = Credentials.from_service_account_info(creds_info, scopes=SCOPES)
-    # cache_discovery=False — чтобы не было шума и лишних файлов
-    SHEETS_SERVICE = build("sheets", "v4", credentials=CREDS, cache_discovery=False)
-    DRIVE_SERVICE  = build("drive",  "v3", credentials=CREDS, cache_discovery=False)
+    payload = {
+        "main_buttons": main_buttons, "submenus": submenus, "texts": texts,
+        # mtime — чтобы тёплый из Redis инстанс мог пропустить перезагрузку неизменённой таблицы
+        "modified_time": last_modified_time, "checked_at": guides_checked_at,
+    }
+    try:
+        await r.setex(GUIDES_KEY, GUIDES_TTL, orjson.dumps(payload))
+    except Exception as e:
+        logging.warning(f"Redis setex {GUIDES_KEY} failed: {e}")
 
-async def load_guides(force=False):
+# снимаем лизу, только если она всё ещё наша (могла истечь и достаться другому инстансу)
+RELEASE_LEASE_LUA = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
+async def acquire_refresh_lease() -> Optional[str]:
     """
-    Подтягивает кнопки/тексты из Google Sheets.
+    SET NX EX — в Sheets за обновлением ходит только один инстанс.
+    Возвращает токен лизы или None, если обновляет другой инстанс.
     """
-    global main_buttons, submenus, texts, main_menu
-    if guides_cache.get("ok") and not force:
+    token = secrets.token_hex(8)
+    r = get_redis()
+    if r is None:
+        return token
+    try:
+        if await r.set(GUIDES_LEASE_KEY, token, nx=True, ex=GUIDES_LEASE_TTL):
+            return token
+        return None
+    except (RedisError, OSError) as e:
+        logging.warning(f"Redis lease failed: {e}")
+        return token
+
+async def release_refresh_lease(token: str):
+    r = get_redis()
+    if r is None:
         return
+    try:
+        await r.eval(RELEASE_LEASE_LUA, 1, GUIDES_LEASE_KEY, token)
+    except (RedisError, OSError) as e:
+        logging.warning(f"Redis lease release failed: {e}")
 
-    ensure_google()
+async def wait_for_shared_guides() -> bool:
+    for _ in range(int(GUIDES_LEASE_WAIT / 0.25)):
+        await asyncio.sleep(0.25)
+        if await load_shared_guides():
+            return True
+    return False
 
-    max_retries, delay = 4, 1.0
-    for attempt in range(1, max_retries + 1):
-        try:
-            result = SHEETS_SERVICE.spreadsheets().values().get(
-                spreadsheetId=config.SHEET_ID, range=config.RANGE_NAME
-            ).execute()
-            values = result.get("values", [])
-            if not values:
-                logging.warning(f"No data found in range {config.RANGE_NAME}.")
+async def load_guides(force=False):
+    """
+    Подтягивает кнопки/тексты из Google Sheets.
+    Конкурентные вызовы на инстансе ждут один и тот же запрос (asyncio.Lock),
+    между инстансами — лиза в Redis.
+    """
+    if guides_fresh() and not force:
+        return
+    lease: Optional[str] = None
+    if not force:
+        async with _guides_lock:
+            if guides_fresh() or await load_shared_guides():
                 return
-            # пропустим заголовок, если есть
-            if len(values[0]) < 3 or values[0][1].lower() == "button":
-                values = values[1:]
-
-            main_buttons = []
-            submenus = {}
-            texts = {}
-
-            for row in values:
-                if len(row) < 3:
-                    continue
-                parent = sanitize_text(row[0], sanitize=False) if row[0] else None
-                button = sanitize_text(row[1], sanitize=False)
-                text = (row[2] or "").strip() or "Текст не найден в Google Sheets."
-                texts[button] = text
-                if not parent:
-                    main_buttons.append(button)
-                else:
-                    submenus.setdefault(parent, []).append(button)
-
-            buttons = [[KeyboardButton(text=btn)] for btn in main_buttons]
-            # is_persistent — меню всегда доступно
-            main_menu = ReplyKeyboardMarkup(keyboard=buttons, resize_keyboard=True, is_persistent=True)
-
-            guides_cache["ok"] = True
-            logging.info(f"Guides loaded: {len(main_buttons)} main, {sum(len(v) for v in submenus.values())} sub")
+            lease = await acquire_refresh_lease()
+        # лизу держит другой инстанс: недолго ждём его результат вне _guides_lock,
+        # не дождались — обновляем сами, а не отвечаем с пустым кэшем
+        if lease is None and await wait_for_shared_guides():
             return
+    async with _guides_lock:
+        try:
+            if guides_fresh() and not force:
+                return
+            await fetch_guides(force)
+        finally:
+            if lease is not None:
+                await release_refresh_lease(lease)
+
+RETRYABLE_STATUSES = (429, 500, 503)
+MAX_BACKOFF = 10.0                            # потолок паузы между повторами: вебхук ограничен по времени
+
+def is_transient(e: Exception) -> bool:
+    if isinstance(e, GoogleApiError):
+        return e.status in RETRYABLE_STATUSES
+    return isinstance(e, (aiohttp.ClientError, asyncio.TimeoutError, ssl.SSLError))
+
+def retry_after(e: Exception) -> float:
+    return e.retry_after if isinstance(e, GoogleApiError) else 0.0
 
-        except HttpError as e:
-            if e.resp.status == 429:
-                logging.warning(f"Sheets rate limit, retrying: {e}")
-                await asyncio.sleep(max(5.0, delay))
-                delay = min(delay * 2, 10.0)
-            else:
-                logging.error(f"HTTP Error {e.resp.status}: {e}")
-                break
+async def fetch_values(max_tries: int = 5) -> List[List[str]]:
+    """
+    Читает RANGE_NAME с экспоненциальным бэкоффом; Retry-After от Google имеет приоритет.
+    """
+    delay = 1.0
+    for attempt in range(1, max_tries + 1):
+        try:
+            result = await google_get(SHEETS_VALUES_URL.format(
+                sheet_id=config.SHEET_ID, range=quote(config.RANGE_NAME, safe="")
+            ), fields="values")
+            return result.get("values", [])
         except Exception as e:
-            if isinstance(e, ssl.SSLError) or "EOF occurred" in str(e):
-                logging.warning(f"Transient SSL on load_guides (attempt {attempt}/{max_retries}): {e}")
-                await asyncio.sleep(delay)
-                delay = min(delay * 2, 10.0)
-                continue
-            logging.error(f"Unexpected load_guides error: {e}")
-            break
-
-async def send_album_and_text(chat_id: int, guide_text: str) -> List[int]:
-    sent_ids: List[int] = []
-    urls = extract_urls_ordered(guide_text)
-    media, anims, docs = split_media(urls)
+            if attempt == max_tries or not is_transient(e):
+                raise
+            # джиттер разводит повторы параллельных инстансов, чтобы не долбить квоту синхронно
+            wait = min(retry_after(e) or delay + uniform(0, delay), MAX_BACKOFF)
+            logging.warning(f"Transient Sheets error (attempt {attempt}/{max_tries}), retry in {wait:.1f}s: {e}")
+            await asyncio.sleep(wait)
+            delay = min(delay * 2, MAX_BACKOFF)
+    return []
+
+async def sheet_modified_time() -> Optional[str]:
+    # дешёвая проверка «изменилась ли таблица» через метаданные Drive
+    try:
+        meta = await google_get(DRIVE_FILE_URL.format(file_id=config.SHEET_ID), fields="modifiedTime")
+        return meta.get("modifiedTime")
+    except Exception as e:
+        logging.warning(f"Drive modifiedTime probe failed: {e}")
+        return None
+
+async def fetch_guides(force: bool = False):
+    modified_time = await sheet_modified_time()
+    if not force and parsed_guides and modified_time and modified_time == last_modified_time:
+        # таблица не менялась — только продлеваем TTL, без values.get и перепарсинга
+        mark_guides_fresh()
+        await store_shared_guides()
+        logging.debug("Sheet not modified, TTL refreshed")
+        return
+
+    try:
+        values = await fetch_values()
+    except GoogleApiError as e:
+        logging.error(f"HTTP Error {e.status}: {e}")
+        return
+    except Exception as e:
+        logging.error(f"Unexpected load_guides error: {e}")
+        return
 
-    # 1) альбом фото/видео
+    if not values:
+        logging.warning(f"No data found in range {config.RANGE_NAME}.")
+        return
+    # пропустим заголовок, если есть
+    if len(values[0]) < 3 or values[0][1].lower() == "button":
+        values = values[1:]
+
+    rows = [r for r in values if len(r) >= 3]
+    parents = [r[0].strip()[:100] if r[0] else "" for r in rows]
+    buttons = [r[1].strip()[:100] for r in rows]
+    new_texts: Dict[str, str] = dict(zip(buttons, ((r[2] or "").strip() or NOT_FOUND_TEXT for r in rows)))
+
+    new_buttons: List[str] = []
+    new_submenus: Dict[str, List[str]] = {}
+    add_main, add_sub = new_buttons.append, new_submenus.setdefault
+    for parent, button in zip(parents, buttons):
+        if parent:
+            add_sub(parent, []).append(button)
+        else:
+            add_main(button)
+
+    apply_guides(new_buttons, new_submenus, new_texts, modified_time)
+    await store_shared_guides()
+    logging.info(f"Guides loaded: {len(main_buttons)} main, {sum(len(v) for v in submenus.values())} sub")
+
+def send_single_media(chat_id: int, item: types.InputMedia, **kwargs):
+    if isinstance(item, InputMediaPhoto):
+        return bot.send_photo(chat_id, item.media, **kwargs)
+    if isinstance(item, InputMediaVideo):
+        return bot.send_video(chat_id, item.media, **kwargs)
+    return bot.send_document(chat_id, item.media, **kwargs)
+
+async def gather_sends(calls, what: str) -> List[int]:
+    # параллельная отправка; message_id собираются в исходном порядке
+    results = await asyncio.gather(*(c() for c in calls), return_exceptions=True)
+    ids: List[int] = []
+    for res in results:
+        if isinstance(res, Exception):
+            logging.error(f"{what} failed: {res}")
+        else:
+            ids.append(res.message_id)
+    return ids
+
+async def send_album(chat_id: int, media: List[types.InputMedia]) -> List[int]:
     if len(media) == 1:
-        item = media[0]
         try:
-            if isinstance(item, InputMediaPhoto):
-                msg = await bot.send_photo(chat_id, item.media)
-            elif isinstance(item, InputMediaVideo):
-                msg = await bot.send_video(chat_id, item.media)
-            else:
-                msg = await bot.send_document(chat_id, item.media)
-            sent_ids.append(msg.message_id)
+            msg = await send_single_media(chat_id, media[0])
+            return [msg.message_id]
         except Exception as e:
             logging.error(f"send single media failed: {e}")
-    elif len(media) > 1:
+            return []
+    if len(media) > 1:
         try:
             group = await bot.send_media_group(chat_id=chat_id, media=media)
-            sent_ids.extend([m.message_id for m in group])
+            return [m.message_id for m in group]
         except Exception as e:
             logging.error(f"send_media_group failed: {e}")
             # fallback — по одному
-            for item in media:
-                try:
-                    if isinstance(item, InputMediaPhoto):
-                        msg = await bot.send_photo(chat_id, item.media)
-                    elif isinstance(item, InputMediaVideo):
-                        msg = await bot.send_video(chat_id, item.media)
-                    else:
-                        msg = await bot.send_document(chat_id, item.media)
-                    sent_ids.append(msg.message_id)
-                    await asyncio.sleep(0.25)
-                except Exception as e2:
-                    logging.error(f"fallback single media failed: {e2}")
-
-    # 2) gif
-    for aurl in anims[:10]:
-        try:
-            msg = await bot.send_animation(chat_id, aurl)
-            sent_ids.append(msg.message_id)
-            await asyncio.sleep(0.15)
-        except Exception as e:
-            logging.error(f"send_animation failed: {e}")
+            return await gather_sends(
+                [partial(send_single_media, chat_id, item) for item in media], "fallback single media"
+            )
+    return []
+
+CAPTION_LIMIT = 1024
 
-    # 3) документы
-    for durl in docs[:10]:
+async def send_album_and_text(chat_id: int, guide: Guide) -> List[int]:
+    text_without_urls, media, anims, docs = guide
+    text = text_without_urls or "Выберите следующий раздел:"
+
+    # самый частый гайд — одна картинка и короткий текст: одно сообщение с подписью и меню
+    if len(media) == 1 and not anims and not docs and len(text) <= CAPTION_LIMIT:
         try:
-            msg = await bot.send_document(chat_id, durl)
-            sent_ids.append(msg.message_id)
-            await asyncio.sleep(0.15)
+            msg = await send_single_media(chat_id, media[0], caption=text, reply_markup=main_menu)
+            return [msg.message_id]
         except Exception as e:
-            logging.error(f"send_document failed: {e}")
-
-    # 4) текст
-    text_without_urls = URL_RE.sub("", guide_text).strip()
-    if text_without_urls:
-        msg = await bot.send_message(chat_id, text_without_urls, reply_markup=main_menu)
+            logging.error(f"send media with caption failed: {e}")
+
+    # альбом, gif/документы и текст с меню независимы — отправляем одновременно
+    album_ids, extra_ids, text_msg = await asyncio.gather(
+        send_album(chat_id, media),
+        gather_sends(
+            [partial(bot.send_animation, chat_id, aurl) for aurl in anims[:10]]
+            + [partial(bot.send_document, chat_id, durl) for durl in docs[:10]],
+            "send_animation/send_document",
+        ),
+        bot.send_message(chat_id, text, reply_markup=main_menu),
+        return_exceptions=True,
+    )
+    sent_ids: List[int] = []
+    for ids in (album_ids, extra_ids):
+        if isinstance(ids, Exception):
+            logging.error(f"send media failed: {ids}")
+        else:
+            sent_ids.extend(ids)
+    if isinstance(text_msg, Exception):
+        logging.error(f"send_message failed: {text_msg}")
     else:
-        msg = await bot.send_message(chat_id, "Выберите следующий раздел:", reply_markup=main_menu)
-    sent_ids.append(msg.message_id)
+        sent_ids.append(text_msg.message_id)
     return sent_ids
 
 # ---------------------- AIOGRAM HANDLERS ----------------------
 @dp.message(Command("start"))
 async def cmd_start(message: types.Message):
-    await load_guides()
-    if has_access(message.from_user.id):
-        await message.answer("Главное меню:", reply_markup=main_menu)
-    else:
+    if not await has_access(message.from_user.id):
         await message.answer("Введите код доступа.")
+        return
+    await load_guides()
+    await message.answer("Главное меню:", reply_markup=main_menu)
 
 @dp.message(Command("reload"))
 async def cmd_reload(message: types.Message):
     # всем доступно: перезагружаем данные и сбрасываем сессии
-    guides_cache.clear()
+    invalidate_guides()
     await load_guides(force=True)
-    reset_all_sessions()
+    await reset_all_sessions()
     await message.answer("Бот обновлён. Введите код доступа.")
 
 @dp.message()
 async def main_handler(message: types.Message):
-    await load_guides()
     user_id = message.from_user.id
-    if not hasattr(message, "text"):
-        await message.answer("Неизвестная команда. Используйте кнопки ⬇️", reply_markup=main_menu)
-        return
+    txt = (message.text or "").strip()
 
-    txt = message.text.strip()
-    if not has_access(user_id):
+    # сначала самый дешёвый фильтр: неавторизованные не трогают гайды вообще
+    if not await has_access(user_id):
         if txt == "infobot":
             await grant_access(user_id)
+            await load_guides()
             await message.answer("Доступ предоставлен на 30 минут. Главное меню:", reply_markup=main_menu)
         else:
             await message.answer("Введите код доступа.")
         return
 
+    await load_guides()
+    if not txt:
+        await message.answer("Неизвестная команда. Используйте кнопки ⬇️", reply_markup=main_menu)
+        return
+
     # авторизован
-    if txt in main_buttons:
-        if txt in submenus:
-            kb = InlineKeyboardMarkup(inline_keyboard=[
-                [InlineKeyboardButton(text=b, callback_data=make_cb_data(b))]
-                for b in submenus[txt]
-            ])
-            await message.answer(f"Выберите опцию для {txt}:", reply_markup=kb)
+    if txt in main_buttons_set:
+        if txt in submenu_markups:
+            await message.answer(f"Выберите опцию для {txt}:", reply_markup=submenu_markups[txt])
         else:
-            guide_text = texts.get(txt, "Текст не найден в Google Sheets.").strip()
-            await send_album_and_text(user_id, guide_text)
+            await send_album_and_text(user_id, get_parsed_guide(txt))
     else:
         await message.answer("Пожалуйста, используйте кнопки ⬇️", reply_markup=main_menu)
 
@@ -353,10 +683,10 @@ async def process_callback(callback: types.CallbackQuery):
     except Exception:
         pass
 
-    await load_guides()
-    if not has_access(callback.from_user.id):
+    if not await has_access(callback.from_user.id):
         await callback.message.answer("Доступ истек. Введите код доступа.", reply_markup=main_menu)
         return
+    await load_guides()
 
     btn = resolve_btn_from_cb(callback.data or "")
     if not btn:
@@ -364,22 +694,39 @@ async def process_callback(callback: types.CallbackQuery):
         await callback.message.answer("Элемент не найден. Обновите меню (/reload).", reply_markup=main_menu)
         return
 
-    guide_text = texts.get(btn)
-    if guide_text is None:
-        guides_cache.clear()
+    if btn not in parsed_guides:
+        invalidate_guides()
         await load_guides(force=True)
-        guide_text = texts.get(btn, "Текст не найден в Google Sheets.")
-    await send_album_and_text(callback.from_user.id, guide_text.strip())
+    await send_album_and_text(callback.from_user.id, get_parsed_guide(btn))
 
 # ---------------------- VERCEL ENTRY ----------------------
+# потолок одновременно обрабатываемых апдейтов: всплеск не плодит неограниченно задач
+UPDATE_SEM = asyncio.Semaphore(int(os.getenv("UPDATE_CONCURRENCY", "64")))
+update_tasks: set = set()
+
+async def run_update(raw: bytes):
+    async with UPDATE_SEM:
+        try:
+            update = types.Update.model_validate(orjson.loads(raw), context={"bot": bot})
+            await dp.feed_update(bot, update)
+        except Exception as e:
+            logging.error(f"Update handling error: {e}")
+
+@app.on_event("shutdown")
+async def on_shutdown():
+    await bot.session.close()
+    if _http is not None and not _http.closed:
+        await _http.close()
+
 # Важно: Vercel маппит /api/webhook -> ВНУТРИ функции путь "/"
 # поэтому обязательно держим POST "/".
 @app.post("/")
 async def webhook_root(request: Request):
     try:
-        payload = await request.json()
-        # быстрый ACK — обрабатываем апдейт в фоне
-        asyncio.create_task(dp.feed_update(bot, types.Update(**payload)))
+        # быстрый ACK — разбор и обработка апдейта целиком в фоне
+        task = asyncio.create_task(run_update(await request.body()))
+        update_tasks.add(task)
+        task.add_done_callback(update_tasks.discard)
         return {"ok": True}
     except Exception as e:
         logging.error(f"Error processing update: {e}")
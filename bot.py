@@ -2,24 +2,35 @@
 import os
 import re
 import time
-import json
+import hmac
+import uuid
+import hashlib
 import logging
 import sqlite3
 import asyncio
+import threading
+from collections import deque
 from random import uniform
 from typing import Optional, Dict, List, Set
+from urllib.parse import quote
 
+import aiohttp
+import orjson
 from fastapi import FastAPI, Request, HTTPException
+from fastapi.responses import ORJSONResponse
 from aiogram import Bot, Dispatcher, types, F
 from aiogram.enums import ParseMode
 from aiogram.filters import Command
 from aiogram.fsm.storage.memory import MemoryStorage
 from aiogram.client.default import DefaultBotProperties
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.exceptions import TelegramRetryAfter, TelegramBadRequest
+from aiolimiter import AsyncLimiter
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
+from cachetools import TTLCache, LRUCache
 
 from google.oauth2 import service_account
-from googleapiclient.discovery import build
-from googleapiclient.errors import HttpError
+from google.auth.transport.requests import Request as GoogleAuthRequest
 
 # ▶▶ NEW: phone validation module
 from phone import check_phone, format_result_markdown
@@ -33,6 +44,11 @@ class Config:
     PORT = int(os.getenv("PORT", 8000))
     RELOAD_MINUTES = int(os.getenv("RELOAD_MINUTES", "60"))
     CODEWORD = os.getenv("CODEWORD", "infobot")
+    TG_CONNECTION_LIMIT = int(os.getenv("TG_CONNECTION_LIMIT", "100"))
+    UPDATE_CONCURRENCY = int(os.getenv("UPDATE_CONCURRENCY", "64"))
+    TG_RATE_LIMIT = int(os.getenv("TG_RATE_LIMIT", "28"))  # вызовов Bot API в секунду, лимит Telegram ~30
+    DRIVE_PUSH = os.getenv("DRIVE_PUSH", "0") == "1"  # push-уведомления Drive о правках таблицы
+    DRIVE_PUSH_TOKEN = os.getenv("DRIVE_PUSH_TOKEN")  # X-Goog-Channel-Token; по умолчанию выводится из BOT_TOKEN
 
     @property
     def WEBHOOK_URL(self) -> Optional[str]:
@@ -40,6 +56,12 @@ class Config:
             return f"https://{self.KOYEB_PUBLIC_DOMAIN}/webhook"
         return None
 
+    @property
+    def DRIVE_PUSH_URL(self) -> Optional[str]:
+        if self.KOYEB_PUBLIC_DOMAIN:
+            return f"https://{self.KOYEB_PUBLIC_DOMAIN}/drive-webhook"
+        return None
+
 config = Config()
 
 # ---------- Logging ----------
@@ -47,20 +69,27 @@ logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(
 logging.getLogger("apscheduler.executors.default").setLevel(logging.ERROR)
 
 # ---------- Globals ----------
-app = FastAPI()
+# ORJSONResponse по умолчанию: ACK и служебные ответы без стандартного json
+app = FastAPI(default_response_class=ORJSONResponse)
 
 bot: Optional[Bot] = None
 dp: Optional[Dispatcher] = None
 scheduler: Optional[AsyncIOScheduler] = None
 
+CREDS_INFO: Optional[dict] = None  # разобранный GOOGLE_SERVICE_ACCOUNT_KEY, парсится один раз
 CREDS = None
-SHEETS_SERVICE = None
-DRIVE_SERVICE = None
 
 main_buttons: List[str] = []
+main_buttons_set: frozenset = frozenset()  # O(1) проверка нажатой кнопки; порядок — в main_buttons
 submenus: Dict[str, List[str]] = {}
 texts: Dict[str, str] = {}
+submenu_markups: Dict[str, types.InlineKeyboardMarkup] = {}
+main_menu_markup: Optional[types.ReplyKeyboardMarkup] = None
+# текст гайда -> ссылки на картинки; разбор один раз на загрузку гайдов, а не на каждое нажатие
+guide_image_urls: Dict[str, List[str]] = {}
 last_modified_time: Optional[str] = None
+# были ли обращения к гайдам с последнего опроса Drive: без спроса не платим за свежесть
+guides_read_since_poll = False
 
 is_started = False
 is_ready = False
@@ -68,36 +97,69 @@ first_ready_deadline: Optional[float] = None
 
 # ---- Auth ----
 AUTH_TTL = 24 * 60 * 60  # 24 часа
-auth_sessions: Dict[int, float] = {}
-awaiting_code: Set[int] = set()
+# авторизованные user_id; срок жизни отсчитывает сам TTLCache, отдельная метка времени не нужна
+auth_sessions: TTLCache = TTLCache(maxsize=10_000, ttl=AUTH_TTL)
+# ждущие кодовое слово; без TTL множество пополнялось бы каждым, кто не ввёл код
+awaiting_code: TTLCache = TTLCache(maxsize=10_000, ttl=AUTH_TTL)
 
 def is_authed(user_id: int) -> bool:
-    exp = auth_sessions.get(user_id, 0)
-    return exp > time.time()
+    return user_id in auth_sessions
 
 def grant_auth(user_id: int):
-    auth_sessions[user_id] = time.time() + AUTH_TTL
+    # по ёмкости вытесняется только живая сессия: протухшие сначала убираем сами
+    if len(auth_sessions) >= auth_sessions.maxsize:
+        auth_sessions.expire()
+        if len(auth_sessions) >= auth_sessions.maxsize:
+            logging.warning(f"auth_sessions full ({auth_sessions.maxsize}), evicting the oldest session")
+    auth_sessions[user_id] = True
+
+def mark_guides_read():
+    global guides_read_since_poll
+    guides_read_since_poll = True
+
+# ---------- Лимит исходящих вызовов Bot API ----------
+tg_send_limit = AsyncLimiter(config.TG_RATE_LIMIT, 1.0)
+TG_MAX_RETRIES = 3
+
+async def tg_rate_limit(make_request, bot: Bot, method):
+    """Request-middleware сессии: все вызовы Bot API идут через общий лимитер, на флуд-контроль ждём retry_after."""
+    for attempt in range(1, TG_MAX_RETRIES + 1):
+        async with tg_send_limit:
+            try:
+                return await make_request(bot, method)
+            except TelegramRetryAfter as e:
+                if attempt == TG_MAX_RETRIES:
+                    raise
+                wait = e.retry_after
+                logging.warning(f"Telegram flood control on {type(method).__name__}, retry in {wait}s")
+        await asyncio.sleep(wait)
 
 # ---------- Хелперы сообщений / Очистка ----------
-chat_msgs: Dict[int, List[int]] = {}
+MAX_TRACKED_MSGS = 20
+# LRU по чатам: память не растёт с каждым новым пользователем за время аптайма
+chat_msgs: LRUCache = LRUCache(maxsize=50_000)  # chat_id -> deque id сообщений
 
 def _remember_msg(chat_id: int, message_id: int):
-    arr = chat_msgs.setdefault(chat_id, [])
+    # deque(maxlen) сам вытесняет старые id — без пересборки списка
+    arr = chat_msgs.get(chat_id)
+    if arr is None:
+        arr = chat_msgs[chat_id] = deque(maxlen=MAX_TRACKED_MSGS)
     if message_id not in arr:
         arr.append(message_id)
-        if len(arr) > 20:
-            del arr[:-20]
 
 async def purge_chat(chat_id: int):
-    ids = chat_msgs.get(chat_id, [])
+    # забираем очередь целиком: сообщения, пришедшие во время удаления, попадут в новую
+    ids = chat_msgs.pop(chat_id, None)
     if not ids:
         return
-    for mid in reversed(ids):
-        try:
-            await bot.delete_message(chat_id, mid)
-        except Exception:
-            pass
-    chat_msgs[chat_id] = []
+    # deleteMessages удаляет до 100 сообщений за один запрос и сам пропускает уже удалённые
+    try:
+        await bot.delete_messages(chat_id, list(ids))
+        return
+    except Exception as e:
+        logging.debug(f"delete_messages failed, falling back to one by one: {e}")
+    # запасной путь: удаления независимы — параллельно, темп держит лимитер сессии
+    await asyncio.gather(*(bot.delete_message(chat_id, mid) for mid in ids), return_exceptions=True)
 
 # ---------- Callback data helpers ----------
 cb_id_to_key: Dict[str, str] = {}
@@ -118,49 +180,73 @@ def _cb_for(key: str) -> str:
     cb_id_to_key[cid] = key
     return cid
 
-def main_menu_kb() -> types.ReplyKeyboardMarkup:
+def build_main_menu() -> types.ReplyKeyboardMarkup:
     return types.ReplyKeyboardMarkup(
         keyboard=[[types.KeyboardButton(text=b)] for b in main_buttons] or [[types.KeyboardButton(text="(меню пусто)")]],
         resize_keyboard=True
     )
 
+def main_menu_kb() -> types.ReplyKeyboardMarkup:
+    # клавиатура меняется только при загрузке гайдов — отдаём готовый объект
+    global main_menu_markup
+    if main_menu_markup is None:
+        main_menu_markup = build_main_menu()
+    return main_menu_markup
+
 # ---------- SQLite ----------
-def get_sqlite_conn():
-    conn = sqlite3.connect("bot.db", timeout=10)
-    conn.row_factory = sqlite3.Row
-    return conn
+# одно долгоживущее соединение в WAL-режиме вместо connect/close на каждый вызов
+_db: Optional[sqlite3.Connection] = None
+_db_write_lock = threading.Lock()
+
+def get_sqlite_conn() -> sqlite3.Connection:
+    global _db
+    if _db is None:
+        _db = sqlite3.connect("bot.db", timeout=10, check_same_thread=False, isolation_level=None)
+        _db.row_factory = sqlite3.Row
+        _db.execute("PRAGMA auto_vacuum=INCREMENTAL")  # действует для нового файла; освобождённые страницы отдаются ОС
+        _db.execute("PRAGMA journal_mode=WAL")
+        _db.execute("PRAGMA synchronous=NORMAL")
+        _db.execute("PRAGMA temp_store=MEMORY")
+        _db.execute("PRAGMA cache_size=-20000")  # ~20 МБ страничного кэша
+        _db.execute("PRAGMA mmap_size=67108864")  # чтение через mmap, без копирования страниц в буфер
+    return _db
+
+def close_sqlite():
+    global _db
+    if _db is not None:
+        try:
+            _db.execute("PRAGMA optimize")
+        except sqlite3.Error as e:
+            logging.warning(f"PRAGMA optimize failed: {e}")
+        _db.close()
+        _db = None
 
 def init_sqlite():
     conn = get_sqlite_conn()
-    cur = conn.cursor()
-    cur.execute("""
+    conn.execute("""
         CREATE TABLE IF NOT EXISTS guides_cache (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             payload TEXT NOT NULL,
             cached_at INTEGER NOT NULL
         )
     """)
-    conn.commit()
-    conn.close()
     logging.info("SQLite инициализирован")
 
 def cache_guides(payload: dict):
     conn = get_sqlite_conn()
-    cur = conn.cursor()
-    cur.execute("INSERT INTO guides_cache(payload, cached_at) VALUES (?, ?)", (json.dumps(payload, ensure_ascii=False), int(time.time())))
-    conn.commit()
-    conn.close()
+    with _db_write_lock:
+        cur = conn.execute("INSERT INTO guides_cache(payload, cached_at) VALUES (?, ?)", (orjson.dumps(payload).decode(), int(time.time())))
+        # читается только последний снимок — старые удаляем, иначе таблица и WAL растут с каждой перезагрузкой
+        conn.execute("DELETE FROM guides_cache WHERE id < ?", (cur.lastrowid,))
+        conn.execute("PRAGMA incremental_vacuum").fetchall()  # прагма освобождает страницы по шагу, дочитываем до конца
     logging.info("Guides cached to SQLite")
 
 def load_guides_from_cache() -> Optional[dict]:
     conn = get_sqlite_conn()
-    cur = conn.cursor()
-    cur.execute("SELECT payload, cached_at FROM guides_cache ORDER BY cached_at DESC LIMIT 1")
-    row = cur.fetchone()
-    conn.close()
+    row = conn.execute("SELECT payload, cached_at FROM guides_cache ORDER BY id DESC LIMIT 1").fetchone()
     if row:
         try:
-            payload = json.loads(row["payload"])
+            payload = orjson.loads(row["payload"])
             logging.info(f"Loaded guides from cache (cached_at={row['cached_at']})")
             return payload
         except Exception as e:
@@ -177,58 +263,248 @@ def validate_env_vars():
         logging.warning("GOOGLE_SHEET_ID not set — guides unavailable")
 
 # ---------- Google ----------
+# Sheets/Drive REST через общий aiohttp-клиент: keep-alive, без discovery-документов и потоков на каждый вызов
+SHEETS_VALUES_URL = "https://sheets.googleapis.com/v4/spreadsheets/{sheet_id}/values/{range}"
+DRIVE_API_URL = "https://www.googleapis.com/drive/v3"
+GOOGLE_TIMEOUT = aiohttp.ClientTimeout(total=20)
+google_http: Optional[aiohttp.ClientSession] = None
+
+class GoogleApiError(Exception):
+    def __init__(self, status: int, body: str, retry_after: float = 0.0):
+        super().__init__(f"{status}: {body[:200]}")
+        self.status = status
+        self.retry_after = retry_after
+
+def get_google_http() -> aiohttp.ClientSession:
+    global google_http
+    if google_http is None or google_http.closed:
+        google_http = aiohttp.ClientSession(timeout=GOOGLE_TIMEOUT)
+    return google_http
+
+async def google_token() -> str:
+    # refresh синхронный (google-auth) — в поток; valid учитывает запас до истечения
+    if not CREDS.valid:
+        await asyncio.to_thread(CREDS.refresh, GoogleAuthRequest())
+    return CREDS.token
+
+def parse_retry_after(value: Optional[str]) -> float:
+    try:
+        return float(value or 0)
+    except ValueError:
+        return 0.0
+
+async def google_request(method: str, url: str, body: Optional[dict] = None, **params) -> dict:
+    headers = {"Authorization": f"Bearer {await google_token()}"}
+    data = None
+    if body is not None:
+        headers["Content-Type"] = "application/json"
+        data = orjson.dumps(body)
+    async with get_google_http().request(method, url, params=params, headers=headers, data=data) as resp:
+        raw = await resp.read()
+        if resp.status >= 400:
+            raise GoogleApiError(
+                resp.status, raw.decode("utf-8", "replace"), parse_retry_after(resp.headers.get("Retry-After"))
+            )
+        return orjson.loads(raw) if raw else {}
+
+async def google_get(url: str, **params) -> dict:
+    return await google_request("GET", url, **params)
+
 def init_google_services():
-    global CREDS, SHEETS_SERVICE, DRIVE_SERVICE
+    global CREDS_INFO, CREDS
     if not config.GOOGLE_SERVICE_ACCOUNT_KEY:
         logging.warning("Skipping Google init: no key")
         return
     try:
-        info = json.loads(config.GOOGLE_SERVICE_ACCOUNT_KEY)
+        if CREDS_INFO is None:
+            CREDS_INFO = orjson.loads(config.GOOGLE_SERVICE_ACCOUNT_KEY)
         CREDS = service_account.Credentials.from_service_account_info(
-            info,
+            CREDS_INFO,
             scopes=[
                 "https://www.googleapis.com/auth/spreadsheets",
                 "https://www.googleapis.com/auth/drive.metadata.readonly",
             ]
         )
-        SHEETS_SERVICE = build("sheets", "v4", credentials=CREDS, cache_discovery=False)
-        DRIVE_SERVICE = build("drive", "v3", credentials=CREDS, cache_discovery=False)
-        logging.info("Google services initialized")
+        logging.info("Google credentials initialized")
     except Exception as e:
         logging.error(f"Failed to init Google services: {e}")
 
 # ---------- Load guides ----------
+def apply_guides(payload: dict):
+    global main_buttons, main_buttons_set, submenus, submenu_markups, main_menu_markup, texts, last_modified_time
+    main_buttons = payload.get("main_buttons", [])
+    main_buttons_set = frozenset(main_buttons)
+    submenus = payload.get("submenus", {})
+    texts = payload.get("texts", {})
+    last_modified_time = payload.get("last_modified_time")
+
+    # callback id и инлайн-клавиатуры подменю неизменны до следующей загрузки — строим один раз
+    cb_id_to_key.clear()
+    key_to_cb_id.clear()
+    guide_image_urls.clear()
+    main_menu_markup = build_main_menu()
+    submenu_markups = {
+        parent: types.InlineKeyboardMarkup(inline_keyboard=[
+            [types.InlineKeyboardButton(text=_safe_label(it), callback_data=f"sub|{_cb_for(it)}")] for it in items
+        ])
+        for parent, items in submenus.items()
+    }
+
+# modifiedTime таблицы живёт 60 с: пачка force=False вызовов делит один запрос к Drive
+MTIME_TTL = 60
+mtime_value: Optional[str] = None
+mtime_checked_at = 0.0  # time.monotonic() последней проверки
+_mtime_lock = asyncio.Lock()
+
+def remember_mtime(value: Optional[str]):
+    global mtime_value, mtime_checked_at
+    mtime_value, mtime_checked_at = value, time.monotonic()
+
+def invalidate_mtime():
+    global mtime_checked_at
+    mtime_checked_at = 0.0
+
+async def sheet_modified_time(fresh: bool = False) -> Optional[str]:
+    async with _mtime_lock:
+        if not fresh and time.monotonic() - mtime_checked_at < MTIME_TTL:
+            return mtime_value
+        file_meta = await google_get(f"{DRIVE_API_URL}/files/{config.GOOGLE_SHEET_ID}", fields="modifiedTime")
+        remember_mtime(file_meta.get("modifiedTime"))
+        return mtime_value
+
+# курсор Drive Changes API: опрос возвращает только изменения с прошлого раза
+drive_change_token: Optional[str] = None
+
+async def sheet_changed() -> bool:
+    """Менялась ли таблица с прошлого опроса. True, если судить не по чему — тогда решает modifiedTime."""
+    global drive_change_token
+    if not CREDS or not config.GOOGLE_SHEET_ID:
+        return True
+    try:
+        if drive_change_token is None:
+            resp = await google_get(f"{DRIVE_API_URL}/changes/startPageToken")
+            drive_change_token = resp.get("startPageToken")
+            return True
+        changed = False
+        token = drive_change_token
+        while token:
+            resp = await google_get(
+                f"{DRIVE_API_URL}/changes",
+                pageToken=token, pageSize=1000,
+                fields="nextPageToken,newStartPageToken,changes(fileId,time)",
+            )
+            for ch in resp.get("changes", []):
+                if ch.get("fileId") == config.GOOGLE_SHEET_ID:
+                    changed = True
+            if "newStartPageToken" in resp:
+                drive_change_token = resp["newStartPageToken"]
+                break
+            token = resp.get("nextPageToken")
+        if changed:
+            # time из Changes API — момент события, а не modifiedTime файла: кэш сбрасываем,
+            # load_guides сверит настоящий modifiedTime из files().get
+            invalidate_mtime()
+        return changed
+    except Exception as e:
+        logging.warning(f"Drive changes poll failed, falling back to modifiedTime: {e}")
+        drive_change_token = None
+        return True
+
+# ---------- Drive push ----------
+# канал files.watch живёт не дольше суток — продлеваем по расписанию
+DRIVE_PUSH_TTL = 24 * 60 * 60
+DRIVE_PUSH_DEBOUNCE = 5  # правки в таблице идут сериями — одна перезагрузка на серию уведомлений
+# сверяем с X-Goog-Channel-Token. Стабилен между рестартами: канал, открытый до падения или
+# редеплоя, доживает до продления, а не получает 403 на каждое уведомление
+drive_push_token = config.DRIVE_PUSH_TOKEN or hmac.new(
+    (config.BOT_TOKEN or "").encode(), b"drive-push", hashlib.sha256
+).hexdigest()
+drive_channel: Optional[dict] = None  # {"id", "resourceId"} активного канала
+drive_reload_task: Optional[asyncio.Task] = None
+drive_reload_pending = False  # уведомление пришло, пока шла перезагрузка — нужен ещё проход
+# канал может молча перестать доставлять уведомления — при живом канале опрос идёт реже, но не выключается
+DRIVE_PUSH_POLL_INTERVAL = 6 * 60 * 60
+# time.monotonic() последнего опроса Changes API; None — ещё не опрашивали (monotonic идёт от загрузки хоста, не процесса)
+drive_polled_at: Optional[float] = None
+
+async def watch_sheet():
+    """Подписывает /drive-webhook на изменения таблицы; прежний канал закрывается."""
+    global drive_channel
+    if not (config.DRIVE_PUSH and config.DRIVE_PUSH_URL and CREDS and config.GOOGLE_SHEET_ID):
+        return
+    old = drive_channel
+    resp = await google_request("POST", f"{DRIVE_API_URL}/files/{config.GOOGLE_SHEET_ID}/watch", body={
+        "id": uuid.uuid4().hex,
+        "type": "web_hook",
+        "address": config.DRIVE_PUSH_URL,
+        "token": drive_push_token,
+        "expiration": int((time.time() + DRIVE_PUSH_TTL) * 1000),
+    })
+    drive_channel = {"id": resp.get("id"), "resourceId": resp.get("resourceId")}
+    logging.info(f"Drive push channel registered: {drive_channel['id']}")
+    if old:
+        await stop_drive_channel(old)
+
+async def stop_drive_channel(channel: dict):
+    try:
+        await google_request("POST", f"{DRIVE_API_URL}/channels/stop", body=channel)
+    except Exception as e:
+        logging.debug(f"Drive channel stop failed: {e}")
+
+async def reload_after_push():
+    global drive_reload_pending
+    while True:
+        await asyncio.sleep(DRIVE_PUSH_DEBOUNCE)
+        # уведомления за время паузы покрывает эта же загрузка
+        drive_reload_pending = False
+        try:
+            await load_guides(force=True)
+        except Exception as e:
+            logging.error(f"Reload after Drive push failed: {e}")
+        # правка могла прийти после чтения таблицы — перечитываем, иначе она ждёт планового опроса
+        if not drive_reload_pending:
+            return
+
+def backoff(attempt: int, base: float) -> float:
+    # экспонента с джиттером: повторы при 429 не идут синхронно
+    return min(30.0, base * 2 ** (attempt - 1) + uniform(0, 1))
+
+_load_lock = asyncio.Lock()
+
 async def load_guides(force: bool = False, retries: int = 6, base_backoff: float = 1.5):
-    global main_buttons, submenus, texts, last_modified_time
+    if _load_lock.locked() and not force:
+        # загрузка уже идёт (/reload, старт, плановый опрос) — ждём её результат, а не идём в Sheets второй раз
+        async with _load_lock:
+            return
+    async with _load_lock:
+        await _load_guides(force, retries, base_backoff)
 
-    if not SHEETS_SERVICE or not DRIVE_SERVICE or not config.GOOGLE_SHEET_ID:
-        logging.warning("Google services or SHEET_ID missing; will try cache")
-        cached = load_guides_from_cache()
+async def _load_guides(force: bool, retries: int, base_backoff: float):
+    if not CREDS or not config.GOOGLE_SHEET_ID:
+        logging.warning("Google credentials or SHEET_ID missing; will try cache")
+        cached = await asyncio.to_thread(load_guides_from_cache)
         if cached:
-            main_buttons = cached.get("main_buttons", [])
-            submenus = cached.get("submenus", {})
-            texts = cached.get("texts", {})
-            last_modified_time = cached.get("last_modified_time")
+            apply_guides(cached)
             logging.info("Guides loaded from cache (no Google)")
             return
         logging.info("No cache found")
         return
 
     for attempt in range(1, retries + 1):
+        wait = backoff(attempt, base_backoff)
         try:
-            file_meta = DRIVE_SERVICE.files().get(fileId=config.GOOGLE_SHEET_ID, fields="modifiedTime").execute()
-            modified_time = file_meta.get("modifiedTime")
+            modified_time = await sheet_modified_time(fresh=force)
             if not force and last_modified_time and modified_time == last_modified_time:
                 logging.debug("Sheet not modified, skipping load")
                 return
 
-            last_modified_time = modified_time
-            result = SHEETS_SERVICE.spreadsheets().values().get(
-                spreadsheetId=config.GOOGLE_SHEET_ID,
-                range=os.getenv("GOOGLE_SHEET_RANGE", "Guides!A:C")
-            ).execute()
+            result = await google_get(SHEETS_VALUES_URL.format(
+                sheet_id=config.GOOGLE_SHEET_ID,
+                range=quote(os.getenv("GOOGLE_SHEET_RANGE", "Guides!A:C"), safe=""),
+            ), fields="values")  # partial response: без range/majorDimension
             values = result.get("values", [])
-            nb: List[str] = []
+            # dict как упорядоченное множество: дедупликация главных кнопок за O(1), порядок строк сохраняется
+            nb: Dict[str, None] = {}
             ns: Dict[str, List[str]] = {}
             nt: Dict[str, str] = {}
 
@@ -240,82 +516,117 @@ async def load_guides(force: bool = False, retries: int = 6, base_backoff: float
                     continue
 
                 if parent:
-                    if parent not in nb:
-                        nb.append(parent)
+                    nb[parent] = None
                     if btn:
                         ns.setdefault(parent, []).append(btn)
                         if text:
                             nt[btn] = text
                 else:
-                    if btn and btn not in nb:
-                        nb.append(btn)
+                    if btn:
+                        nb[btn] = None
                     if btn and text:
                         nt[btn] = text
 
-            cb_id_to_key.clear()
-            key_to_cb_id.clear()
-            for items in ns.values():
-                for it in items:
-                    _cb_for(it)
-
-            main_buttons = nb
-            submenus = ns
-            texts = nt
-            payload = {"main_buttons": main_buttons, "submenus": submenus, "texts": texts, "last_modified_time": last_modified_time}
-            cache_guides(payload)
+            payload = {"main_buttons": list(nb), "submenus": ns, "texts": nt, "last_modified_time": modified_time}
+            apply_guides(payload)
+            await asyncio.to_thread(cache_guides, payload)
             logging.info(f"Guides loaded: {len(main_buttons)} main, {sum(len(v) for v in submenus.values())} sub")
             return
-        except HttpError as he:
-            logging.error(f"HttpError load_guides {attempt}/{retries}: {he}")
+        except GoogleApiError as ge:
+            logging.error(f"Google API error load_guides {attempt}/{retries}: {ge}")
+            # Retry-After от Google точнее нашей оценки
+            wait = ge.retry_after or wait
         except Exception as e:
             logging.warning(f"Transient error load_guides {attempt}/{retries}: {e}")
 
         if attempt < retries:
-            await asyncio.sleep(base_backoff * attempt + uniform(0, 1))
+            await asyncio.sleep(wait)
 
-    cached = load_guides_from_cache()
+    cached = await asyncio.to_thread(load_guides_from_cache)
     if cached:
-        main_buttons = cached.get("main_buttons", [])
-        submenus = cached.get("submenus", {})
-        texts = cached.get("texts", {})
-        last_modified_time = cached.get("last_modified_time")
+        apply_guides(cached)
         logging.warning("Loaded guides from cache after failures")
     else:
         logging.error("Failed to load guides from Google and no cache")
 
 # ---------- Media utils ----------
 IMG_EXTS = (".jpg", ".jpeg", ".png")
+URL_PREFIXES = ("http://", "https://")
+TOKEN_SPLIT_RE = re.compile(r"[\s,;]+")
+CHECK_CMD_RE = re.compile(r"^/check(?:@\w+)?\s+(.+)$", re.IGNORECASE | re.DOTALL)
 
 def extract_image_urls(text: str) -> List[str]:
     if not text:
         return []
-    urls = []
-    for token in re.split(r"[\s,;\n]+", text.strip()):
-        if token.lower().endswith(IMG_EXTS) and token.startswith(("http://", "https://")):
-            urls.append(token)
-    seen = set()
-    uniq = []
-    for u in urls:
-        if u not in seen:
-            seen.add(u)
-            uniq.append(u)
-    return uniq[:10]  # Telegram альбом до 10 фото
+    urls = (
+        token for token in TOKEN_SPLIT_RE.split(text.strip())
+        if token.startswith(URL_PREFIXES) and token.lower().endswith(IMG_EXTS)
+    )
+    return list(dict.fromkeys(urls))[:10]  # Telegram альбом до 10 фото
+
+# ссылки, которые Telegram не смог скачать: не даём им снова ронять весь альбом
+bad_image_urls: TTLCache = TTLCache(maxsize=1_000, ttl=3600)
+
+# ответы Bot API о самой ссылке; прочие BadRequest (таймаут скачивания, лимиты) в чёрный список не ведут
+BAD_URL_ERRORS = ("wrong file identifier/http url specified", "wrong type of the web page content", "url host is empty")
+
+def mark_bad_url(url: str, e: Exception):
+    if isinstance(e, TelegramBadRequest) and any(err in str(e).lower() for err in BAD_URL_ERRORS):
+        bad_image_urls[url] = True
+
+async def send_photos(chat_id: int, urls: List[str]) -> List[types.Message]:
+    # одиночное фото отправляет send_content_with_menu — сюда приходит альбом из 2–10 ссылок
+    try:
+        return await bot.send_media_group(chat_id, media=[types.InputMediaPhoto(media=u) for u in urls])
+    except Exception as e:
+        logging.warning(f"send_media_group failed, sending photos separately: {e}")
+    # запасной путь — все фото одновременно, один RTT вместо N последовательных
+    results = await asyncio.gather(*(bot.send_photo(chat_id, u) for u in urls), return_exceptions=True)
+    msgs = []
+    for url, res in zip(urls, results):
+        if isinstance(res, Exception):
+            logging.error(f"send_photo failed: {res}")
+            mark_bad_url(url, res)
+        else:
+            msgs.append(res)
+    return msgs
 
 async def send_content_with_menu(chat_id: int, content_text: str):
-    urls = extract_image_urls(content_text)
-    if urls:
-        if len(urls) == 1:
-            m = await bot.send_photo(chat_id, urls[0])
+    urls = guide_image_urls.get(content_text)
+    if urls is None:
+        urls = guide_image_urls[content_text] = extract_image_urls(content_text)
+    all_urls = urls
+    if bad_image_urls:
+        urls = [u for u in urls if u not in bad_image_urls]
+    if len(urls) == 1:
+        # одно фото — подпись и меню в том же сообщении, один запрос вместо двух
+        try:
+            m = await bot.send_photo(chat_id, urls[0], caption="Выберите опцию:", reply_markup=main_menu_kb())
             _remember_msg(chat_id, m.message_id)
-        else:
-            media = [types.InputMediaPhoto(media=u) for u in urls]
-            msgs = await bot.send_media_group(chat_id, media=media)
-            for m in msgs:
+        except Exception as e:
+            logging.error(f"send_content_with_menu failed: {e}")
+            # битая единственная ссылка — самый частый случай; следующий показ уйдёт текстом без неё
+            mark_bad_url(urls[0], e)
+            await show_main_menu(chat_id)
+    elif urls:
+        # фото и сообщение с меню независимы — два запроса к Bot API идут параллельно
+        sent, m2 = await asyncio.gather(
+            send_photos(chat_id, urls),
+            bot.send_message(chat_id, "Выберите опцию:", reply_markup=main_menu_kb()),
+            return_exceptions=True,
+        )
+        for res in (sent, m2):
+            if isinstance(res, Exception):
+                logging.error(f"send_content_with_menu failed: {res}")
+                continue
+            for m in (res if isinstance(res, list) else [res]):
                 _remember_msg(chat_id, m.message_id)
-        m2 = await bot.send_message(chat_id, "Выберите опцию:", reply_markup=main_menu_kb())
-        _remember_msg(chat_id, m2.message_id)
     else:
-        m = await bot.send_message(chat_id, content_text or "Информация отсутствует", reply_markup=main_menu_kb())
+        text = content_text or ""
+        for u in all_urls:
+            # все ссылки отсеяны как битые — не показываем их сырым текстом
+            text = text.replace(u, "")
+        m = await bot.send_message(chat_id, text.strip() or "Информация отсутствует", reply_markup=main_menu_kb())
         _remember_msg(chat_id, m.message_id)
 
 # ---------- UI helpers ----------
@@ -330,7 +641,7 @@ async def cmd_start(message: types.Message):
     _remember_msg(chat_id, message.message_id)
 
     if not is_authed(user_id):
-        awaiting_code.add(user_id)
+        awaiting_code[user_id] = True
         m1 = await message.answer("Доступ к боту защищён. Для входа требуется кодовое слово.")
         _remember_msg(chat_id, m1.message_id)
         m2 = await message.answer("Введите кодовое слово:")
@@ -345,7 +656,7 @@ async def cmd_reload(message: types.Message):
     _remember_msg(chat_id, message.message_id)
 
     if not is_authed(user_id):
-        awaiting_code.add(user_id)
+        awaiting_code[user_id] = True
         m1 = await message.answer("Доступ к боту защищён. Для входа требуется кодовое слово.")
         _remember_msg(chat_id, m1.message_id)
         m2 = await message.answer("Введите кодовое слово:")
@@ -362,7 +673,7 @@ async def cmd_wake(message: types.Message):
     _remember_msg(chat_id, message.message_id)
 
     if not is_authed(user_id):
-        awaiting_code.add(user_id)
+        awaiting_code[user_id] = True
         m1 = await message.answer("Доступ к боту защищён. Для входа требуется кодовое слово.")
         _remember_msg(chat_id, m1.message_id)
         m2 = await message.answer("Введите кодовое слово:")
@@ -380,7 +691,7 @@ async def cmd_check(message: types.Message):
 
     # Auth like other commands
     if not is_authed(user_id):
-        awaiting_code.add(user_id)
+        awaiting_code[user_id] = True
         m1 = await message.answer("Доступ к боту защищён. Для входа требуется кодовое слово.")
         _remember_msg(chat_id, m1.message_id)
         m2 = await message.answer("Введите кодовое слово:")
@@ -390,7 +701,7 @@ async def cmd_check(message: types.Message):
     # Extract phone after /check
     text = (message.text or "").strip()
     # Accept formats: "/check +447..." or "/check 447..." or "/check\n447..."
-    m = re.match(r"^/check(?:@\w+)?\s+(.+)$", text, flags=re.IGNORECASE | re.DOTALL)
+    m = CHECK_CMD_RE.match(text)
     if not m:
         tip = "Пример: <code>/check +447435771497</code>"
         m1 = await message.answer(f"Укажите номер телефона. {tip}")
@@ -414,7 +725,7 @@ async def text_handler(message: types.Message):
 
     if (user_id in awaiting_code) or (not is_authed(user_id)):
         if incoming.lower() == config.CODEWORD.lower():
-            awaiting_code.discard(user_id)
+            awaiting_code.pop(user_id, None)
             grant_auth(user_id)
             await purge_chat(chat_id)
             await show_main_menu(chat_id, text="Доступ разрешён на 24 часа. Выберите опцию:")
@@ -423,12 +734,10 @@ async def text_handler(message: types.Message):
             _remember_msg(chat_id, m.message_id)
         return
 
-    if incoming in main_buttons:
-        items = submenus.get(incoming, [])
-        if items:
-            kb = types.InlineKeyboardMarkup(inline_keyboard=[
-                [types.InlineKeyboardButton(text=_safe_label(it), callback_data=f"sub|{_cb_for(it)}")] for it in items
-            ])
+    mark_guides_read()
+    if incoming in main_buttons_set:
+        kb = submenu_markups.get(incoming)
+        if kb:
             m = await message.answer("Выберите раздел:", reply_markup=kb)
             _remember_msg(chat_id, m.message_id)
         else:
@@ -443,7 +752,7 @@ async def callback_handler(callback: types.CallbackQuery):
     chat_id = callback.message.chat.id
 
     if not is_authed(user_id):
-        awaiting_code.add(user_id)
+        awaiting_code[user_id] = True
         m1 = await callback.message.answer("Доступ к боту защищён. Для входа требуется кодовое слово.")
         _remember_msg(chat_id, m1.message_id)
         m2 = await callback.message.answer("Введите кодовое слово:")
@@ -453,6 +762,7 @@ async def callback_handler(callback: types.CallbackQuery):
 
     data = (callback.data or "")
     if data.startswith("sub|"):
+        mark_guides_read()
         cid = data.split("|", 1)[1]
         key = cb_id_to_key.get(cid, "")
         await purge_chat(chat_id)
@@ -483,16 +793,18 @@ async def ensure_webhook(bot_obj: Bot, url: Optional[str], retries: int = 4):
 @app.on_event("startup")
 async def on_startup():
     global bot, dp, scheduler, is_started, is_ready, first_ready_deadline
-    global main_buttons, submenus, texts, last_modified_time
 
     is_started = True
     first_ready_deadline = time.time() + 120
 
-    init_sqlite()
     validate_env_vars()
-    init_google_services()
+    # открытие SQLite и сборка Google-клиентов блокирующие — параллельно в потоках
+    await asyncio.gather(asyncio.to_thread(init_sqlite), asyncio.to_thread(init_google_services))
 
-    bot_init = Bot(token=config.BOT_TOKEN, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
+    # один пул соединений (keep-alive + DNS-кэш aiogram) на все вызовы Bot API, включая keep-alive и медиа
+    session = AiohttpSession(limit=config.TG_CONNECTION_LIMIT)
+    session.middleware(tg_rate_limit)
+    bot_init = Bot(token=config.BOT_TOKEN, session=session, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
     global bot
     bot = bot_init
     dp_local = Dispatcher(storage=MemoryStorage())
@@ -507,22 +819,27 @@ async def on_startup():
     dp.message.register(text_handler, F.text)
     dp.callback_query.register(callback_handler)
 
+    # set_webhook и первая загрузка гайдов независимы: ждём max, а не сумму задержек
+    _, guides_result, _, watch_result = await asyncio.gather(
+        ensure_webhook(bot, config.WEBHOOK_URL),
+        load_guides(force=True),
+        sheet_changed(),  # берём стартовый курсор Changes API
+        watch_sheet(),
+        return_exceptions=True,
+    )
+    if isinstance(watch_result, Exception):
+        logging.error(f"Drive push setup failed, relying on polling: {watch_result}")
     if config.WEBHOOK_URL:
-        await ensure_webhook(bot, config.WEBHOOK_URL)
         logging.info("Running in WEBHOOK mode")
 
-    try:
-        await load_guides(force=True)
+    if not isinstance(guides_result, Exception):
         if main_buttons:
             is_ready = True
-    except Exception as e:
-        logging.error(f"load_guides startup failed: {e}")
-        cached = load_guides_from_cache()
+    else:
+        logging.error(f"load_guides startup failed: {guides_result}")
+        cached = await asyncio.to_thread(load_guides_from_cache)
         if cached:
-            main_buttons = cached.get("main_buttons", [])
-            submenus = cached.get("submenus", {})
-            texts = cached.get("texts", {})
-            last_modified_time = cached.get("last_modified_time")
+            apply_guides(cached)
             is_ready = True
 
     scheduler_local = AsyncIOScheduler()
@@ -537,12 +854,37 @@ async def on_startup():
             logging.error(f"Keep-alive failed: {e}")
 
     async def single_periodic_reload():
+        global guides_read_since_poll, drive_polled_at
+        if drive_channel and drive_polled_at is not None and time.monotonic() - drive_polled_at < DRIVE_PUSH_POLL_INTERVAL:
+            # изменения приходят push-уведомлениями Drive — страховочный опрос раз в DRIVE_PUSH_POLL_INTERVAL
+            return
+        if not guides_read_since_poll:
+            logging.debug("No guide reads since last poll, skipping Drive check")
+            return
+        guides_read_since_poll = False
+        drive_polled_at = time.monotonic()
         try:
+            if not CREDS:
+                await asyncio.to_thread(init_google_services)
+            if not await sheet_changed():
+                logging.debug("No Drive changes for the sheet, skipping load")
+                return
             await load_guides(force=False)
         except Exception as e:
             logging.error(f"Periodic reload failed: {e}")
 
+    async def single_watch_renew():
+        global drive_channel
+        try:
+            await watch_sheet()
+        except Exception as e:
+            logging.error(f"Drive push renew failed, falling back to polling: {e}")
+            # канал скоро истечёт — до следующего удачного продления работает опрос
+            drive_channel = None
+
     scheduler.add_job(single_keep_alive, "interval", minutes=5, id="keep_alive", replace_existing=True)
+    if config.DRIVE_PUSH:
+        scheduler.add_job(single_watch_renew, "interval", hours=12, id="drive_watch", replace_existing=True)
     scheduler.add_job(single_periodic_reload, "interval", minutes=config.RELOAD_MINUTES, id="periodic_reload", replace_existing=True)
     scheduler.start()
     logging.info("Scheduler started")
@@ -556,18 +898,54 @@ async def on_shutdown():
             scheduler.shutdown(wait=False)
     except Exception:
         pass
+    if bot:
+        await bot.session.close()
+    if drive_channel:
+        await stop_drive_channel(drive_channel)
+    if google_http is not None:
+        await google_http.close()
+    close_sqlite()
 
 # ---------- HTTP ----------
+# держим ссылки на фоновые задачи, иначе GC может собрать их до завершения
+update_tasks: Set[asyncio.Task] = set()
+# ACK уходит сразу, но одновременно обрабатывается не больше UPDATE_CONCURRENCY апдейтов
+update_sem = asyncio.Semaphore(config.UPDATE_CONCURRENCY)
+
+async def process_update(raw: bytes):
+    async with update_sem:
+        try:
+            # model_validate с контекстом бота — как в aiogram'овском webhook-хендлере, без **kwargs-распаковки
+            update = types.Update.model_validate(orjson.loads(raw), context={"bot": bot})
+            await dp.feed_update(bot, update)
+        except Exception as e:
+            logging.error(f"Update handling error: {e}", exc_info=True)
+
 @app.api_route("/webhook", methods=["POST"])
 async def webhook(request: Request):
     try:
-        data = await request.json()
-        update = types.Update(**data)
-        await dp.feed_update(bot, update)
-        return {"ok": True}
+        raw = await request.body()
     except Exception as e:
         logging.error(f"Webhook handling error: {e}", exc_info=True)
         return {"ok": False, "error": str(e)}
+    # быстрый ACK — разбор JSON, валидация и обработка уходят в фон, Telegram не ждёт Sheets и отправку медиа
+    task = asyncio.create_task(process_update(raw))
+    update_tasks.add(task)
+    task.add_done_callback(update_tasks.discard)
+    return {"ok": True}
+
+@app.post("/drive-webhook")
+async def drive_webhook(request: Request):
+    global drive_reload_task, drive_reload_pending
+    if request.headers.get("X-Goog-Channel-Token") != drive_push_token:
+        raise HTTPException(status_code=403, detail="Bad channel token")
+    # "sync" приходит при создании канала, правки — "update"
+    if request.headers.get("X-Goog-Resource-State") in ("update", "change"):
+        if drive_reload_task is None or drive_reload_task.done():
+            drive_reload_task = asyncio.create_task(reload_after_push())
+        else:
+            drive_reload_pending = True
+    return {"ok": True}
 
 @app.get("/ready")
 async def readiness():
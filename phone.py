@@ -15,6 +15,8 @@ NUMLOOKUP_ENDPOINT = "https://api.numlookupapi.com/v1/validate/{number}"
 # Separate connect/read timeouts (connect=1s, read=10s)
 HTTP_TIMEOUT = (1, 10)
 
+NON_DIGIT_RE = re.compile(r"\D")
+
 
 def normalize_number(user_input: str) -> str:
     """Normalize a phone number."""
@@ -22,9 +24,9 @@ def normalize_number(user_input: str) -> str:
     if not s:
         return ""
     if s.startswith("+"):
-        digits = re.sub(r"\D", "", s[1:])
+        digits = NON_DIGIT_RE.sub("", s[1:])
         return f"+{digits}" if digits else "+"
-    return re.sub(r"\D", "", s)
+    return NON_DIGIT_RE.sub("", s)
 
 
 def _safe_get_json(resp: requests.Response) -> Any: